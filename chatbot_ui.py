@@ -1,64 +1,144 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
 import json
 import random
 from datetime import datetime
+import paddleocr
 from paddleocr import PaddleOCR
 from PIL import Image
+from io import BytesIO
 import numpy as np
 import tempfile
 import os
 import traceback
+import re
+import ast
+import operator
+import functools
+import math
+import gc
+import time
+import queue
+import threading
+import logging
 
 st.set_page_config(page_title="Gemma 3 Chatbot + Robust OCR", layout="centered")
 st.title("🤖 Gemma 3 Chatbot + Robust PaddleOCR")
 
 if "messages" not in st.session_state:
     st.session_state["messages"] = []
+if "_attachments" not in st.session_state:
+    st.session_state["_attachments"] = {}
+
+def _ocr_kwarg_attempts():
+    # 2.x silently accepts unknown kwargs, so pick the set by version instead of
+    # waiting for an exception. Tried in order; the last one must work.
+    base = dict(use_angle_cls=True, lang="en", enable_mkldnn=True)
+    if int(paddleocr.__version__.split(".")[0]) >= 3:
+        base.update(
+            cpu_threads=os.cpu_count(),
+            text_recognition_batch_size=1,
+            textline_orientation_batch_size=1,
+        )
+        # HPI needs an optional plugin; without it keep everything else
+        return [dict(base, enable_hpi=True, precision="fp16"), base]
+    # On 2.x precision="fp16" + mkldnn would switch to bfloat16, so leave it out
+    return [dict(base, cpu_threads=os.cpu_count(), rec_batch_num=1, cls_batch_num=1)]
 
 @st.cache_resource
 def load_ocr():
-    # Only include very safe args so it works across versions
-    return PaddleOCR(use_angle_cls=True, lang="en")
+    # Try the fast inference settings first, then fall back to safer args
+    # so it still works across versions.
+    # Batch size 1: we OCR one image at a time, and bigger batches only grow
+    # Paddle's memory arena on CPU.
+    *attempts, last = _ocr_kwarg_attempts()
+    for kwargs in attempts:
+        try:
+            model = PaddleOCR(**kwargs)
+            break
+        except Exception:
+            logging.warning("PaddleOCR init failed with %s, falling back", kwargs, exc_info=True)
+    else:
+        model = PaddleOCR(**last)
+    # Warm up once here (cached) so the user's first click doesn't pay for
+    # kernel init / MKLDNN setup
+    try:
+        model.ocr(np.zeros((64, 256, 3), dtype=np.uint8))
+    except Exception:
+        pass
+    return model
 
-ocr_model = load_ocr()
+def unload_models():
+    # Drop the cached OCR model so its memory is actually released; it's
+    # loaded again lazily on the next Extract Text
+    load_ocr.clear()
+    # Stop this session from pre-loading it again on the rerun
+    st.session_state["_models_unloaded"] = True
+    gc.collect()
+    try:
+        import torch
+        torch.cuda.empty_cache()
+    except Exception:
+        pass
 
 st.sidebar.title("Controls")
+unload_on_clear = st.sidebar.checkbox("Also unload models", value=False)
 if st.sidebar.button("Clear Chat"):
     st.session_state["messages"] = []
+    st.session_state["_attachments"] = {}
+    if unload_on_clear:
+        unload_models()
     st.rerun()
 if st.sidebar.button("Reset App"):
     st.session_state.clear()
+    unload_models()
     st.rerun()
 
+# Build + warm the OCR model in the background on a session's first run, so the
+# first Extract Text doesn't pay for it (cached, so later sessions return at once)
+if "_ocr_preload" not in st.session_state and not st.session_state.get("_models_unloaded"):
+    st.session_state["_ocr_preload"] = True
+    preload = threading.Thread(target=load_ocr, daemon=True)
+    add_script_run_ctx(preload, get_script_run_ctx())
+    preload.start()
+
+with st.sidebar.expander("Advanced"):
+    # Larger images only slow the detector down; text stays readable at this size
+    max_side = st.slider("Max image side for OCR (px)", 640, 4096, 1600, step=160)
+
 st.subheader("Upload Text / CSV file")
 uploaded_file = st.file_uploader("Upload file", type=["txt", "csv"])
 if uploaded_file:
     try:
-        content = uploaded_file.read().decode("utf-8")
-        preview = content[:500]
+        # Only the preview is shown, so read just enough bytes for 500 chars
+        # (UTF-8 is at most 4 bytes/char) and don't fail on non-UTF-8 files
+        uploaded_file.seek(0)
+        raw = uploaded_file.read(500 * 4)
+        preview = raw.decode("utf-8", errors="replace")[:500]
         st.text_area("Preview", preview, height=150)
-        st.session_state["messages"].append({"role":"assistant","content":f"File uploaded. Preview:\n{preview}..."})
+        # Keep the preview out of the chat text so it isn't markdown-parsed on every rerun
+        attachment_id = uploaded_file.file_id
+        if attachment_id not in st.session_state["_attachments"]:
+            st.session_state["_attachments"][attachment_id] = f"{preview}..."
+            st.session_state["messages"].append({"role":"assistant","content":"File uploaded.","attachment_id":attachment_id})
     except Exception as e:
         st.error(f"Error reading file: {e}")
 
 st.subheader("OCR — Upload image for text extraction")
 uploaded_image = st.file_uploader("Upload image (jpg/png)", type=["jpg","jpeg","png"])
 
-def safe_call_ocr(model, img_arg, is_path=False):
+def safe_call_ocr(model, img_arg, raw_bytes=None, suffix=".png"):
     """
     Try multiple safe ways to call PaddleOCR:
      - model.ocr(img_array)  (preferred)
      - model.predict(img_array) (fallback)
-     - model.ocr(path) (fallback)
+     - model.ocr(path) (fallback, original uploaded bytes written to a temp file)
     Return (result, method_name, exception_if_any)
     """
     # 1) try ocr(img_np)
     try:
-        if is_path:
-            res = model.ocr(img_arg)  # some versions accept path
-        else:
-            res = model.ocr(img_arg)
+        res = model.ocr(img_arg)
         return res, "ocr(img)", None
     except Exception as e1:
         # 2) try predict(img_np) if available
@@ -67,13 +147,12 @@ def safe_call_ocr(model, img_arg, is_path=False):
                 res = model.predict(img_arg)  # no extra kwargs
                 return res, "predict(img)", None
         except Exception as e2:
-            # 3) try calling ocr with path (if we passed array before)
-            if not is_path:
+            # 3) try calling ocr with path to the original bytes (no re-encode)
+            if raw_bytes is not None:
                 try:
-                    # if img_arg is numpy array -> write to temp file and pass path
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
+                    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
                         tmp_path = tmp.name
-                        Image.fromarray(img_arg).save(tmp_path)
+                        tmp.write(raw_bytes)
                     try:
                         res = model.ocr(tmp_path)
                         return res, "ocr(path)", None
@@ -90,127 +169,271 @@ def parse_paddle_result(raw):
     """
     Normalize various PaddleOCR return shapes into list of text lines.
     """
-    lines = []
-    if raw is None:
-        return lines
-    # Some versions return list of [ [box, (text,score)], ... ] blocks
+    if not raw:
+        return []
     try:
-        if isinstance(raw, list):
-            for block in raw:
-                # If block is dict-style (newer versions), try keys
-                if isinstance(block, dict):
-                    # modern style: dict with rec_texts
-                    if "rec_texts" in block:
-                        for t in block["rec_texts"]:
-                            if t and str(t).strip():
-                                lines.append(str(t).strip())
-                    else:
-                        # fallback: iterate values
-                        continue
-                elif isinstance(block, list):
-                    for item in block:
-                        try:
-                            # item usually [box, (text, score)]
-                            text = item[1][0] if isinstance(item[1], (list,tuple)) else item[1]
-                            if text and str(text).strip():
-                                lines.append(str(text).strip())
-                        except Exception:
-                            # fallback if item is different shape
-                            try:
-                                # maybe item is (text, score)
-                                if isinstance(item, (list, tuple)) and len(item) >= 2:
-                                    lines.append(str(item[0]))
-                            except:
-                                pass
-                else:
-                    # unknown block type — try to stringify
-                    try:
-                        txt = str(block)
-                        if txt.strip():
-                            lines.append(txt.strip())
-                    except:
-                        pass
-        return lines
+        # modern style: list of dicts with rec_texts
+        if isinstance(raw[0], dict):
+            return [t.strip() for b in raw for t in b.get("rec_texts", ()) if t and t.strip()]
+        # older style: list of [ [box, (text,score)], ... ] blocks (None when a page is empty)
+        return [item[1][0].strip() for block in raw if block for item in block
+                if item and item[1] and item[1][0].strip()]
     except Exception:
         # last resort: return stringified raw
         return [str(raw)]
 
+def open_image(src, max_side):
+    """
+    Decode an image to RGB with its longest side capped at max_side.
+    For JPEG/MPO, draft() makes libjpeg decode straight to a reduced scale
+    (1/2, 1/4, 1/8); other formats (PNG) decode fully and are then resized.
+    """
+    pil = Image.open(src)
+    # draft() only picks a scale that keeps *both* sides >= the box, so give it
+    # the aspect-preserving target, not (max_side, max_side). No-op for non-JPEG.
+    scale = max_side / max(pil.size)
+    if scale < 1:
+        pil.draft("RGB", (round(pil.width * scale), round(pil.height * scale)))
+    pil = pil.convert("RGB")
+    pil.thumbnail((max_side, max_side), Image.BILINEAR)
+    return pil
+
+@st.cache_data(show_spinner=False, max_entries=2, ttl=600)
+def decode_image(img_bytes, max_side):
+    # Decode once per upload; shared by the preview and OCR across reruns.
+    # Entries are full RGB arrays (~50 MB at 4096 px), so only keep the current
+    # image plus one more (e.g. the previous slider value)
+    return np.asarray(open_image(BytesIO(img_bytes), max_side))
+
+@st.cache_resource
+def _ocr_lock():
+    return threading.Lock()
+
+# Enough of the raw OCR result to debug an empty page without caching huge strings
+_RAW_DEBUG_CHARS = 2000
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def run_ocr_cached(img_bytes, max_side, suffix=".png"):
+    """
+    OCR an uploaded image, memoized on its bytes so re-clicks and reruns are free.
+    Return (text_lines, raw_result_str_if_no_text), the raw string capped at
+    _RAW_DEBUG_CHARS since 3.x results embed image arrays. Raises RuntimeError (not cached)
+    with the repr of each attempt's exception if every call pattern failed.
+    """
+    img_np = decode_image(img_bytes, max_side)
+    # Paddle predictors aren't thread-safe and the model is shared by all sessions
+    with _ocr_lock():
+        result, method, err = safe_call_ocr(load_ocr(), img_np, raw_bytes=img_bytes, suffix=suffix)
+    if result is None:
+        raise RuntimeError(*[repr(exc) for exc in (err if isinstance(err, (list,tuple)) else [err])])
+    texts = parse_paddle_result(result)
+    if texts:
+        return texts, None
+    raw_text = str(result)
+    if len(raw_text) > _RAW_DEBUG_CHARS:
+        raw_text = raw_text[:_RAW_DEBUG_CHARS] + f"\n... ({len(raw_text) - _RAW_DEBUG_CHARS} more chars)"
+    return texts, raw_text
+
+def _ocr_worker(img_bytes, max_side, suffix, q):
+    # Runs off the script thread; the UI polls q for ("ok", result) / ("error", reprs, tb)
+    try:
+        q.put(("ok", run_ocr_cached(img_bytes, max_side, suffix=suffix)))
+    except Exception as e:
+        reprs = e.args if isinstance(e, RuntimeError) else (repr(e),)
+        q.put(("error", reprs, traceback.format_exc()))
+
+# Collect a finished background job before drawing the button, so it's
+# re-enabled in the same run that shows the result
+ocr_job = None
+if "_ocr_queue" in st.session_state:
+    try:
+        ocr_job = st.session_state["_ocr_queue"].get_nowait()
+        del st.session_state["_ocr_queue"]
+    except queue.Empty:
+        pass
+ocr_pending = "_ocr_queue" in st.session_state
+
 if uploaded_image:
-    pil = Image.open(uploaded_image).convert("RGB")
-    st.image(pil, caption="Uploaded image", use_container_width=True)
-
-    if st.button("Extract Text"):
-        with st.spinner("Running OCR..."):
-            img_np = np.array(pil)
-
-            result, method, err = safe_call_ocr(ocr_model, img_np, is_path=False)
-
-            if result is None:
-                st.error("OCR failed to run with available call patterns.")
-                if err:
-                    st.write("Exceptions (first, second, third):")
-                    for exc in (err if isinstance(err, (list,tuple)) else [err]):
-                        st.write(repr(exc))
-                    st.write("Full traceback for debugging:")
-                    st.text(traceback.format_exc())
-            else:
-                texts = parse_paddle_result(result)
-                if texts:
-                    out = "\n".join(texts)
-                    st.text_area("OCR Output", out, height=250)
-                    st.session_state["messages"].append({"role":"assistant","content":f"OCR Result:\n{out}"})
-                else:
-                    st.warning("No readable text detected. Raw OCR result shown below for debugging:")
-                    st.write(result)
-                    st.session_state["messages"].append({"role":"assistant","content":"OCR Result: [no readable text]"})
+    img_np = decode_image(uploaded_image.getvalue(), max_side)
+    st.image(img_np, caption="Uploaded image", use_container_width=True)
+
+    # Only one OCR job per session at a time
+    if st.button("Extract Text", disabled=ocr_pending) and not ocr_pending:
+        q = queue.Queue()
+        worker = threading.Thread(
+            target=_ocr_worker,
+            args=(
+                uploaded_image.getvalue(),
+                max_side,
+                os.path.splitext(uploaded_image.name)[1] or ".png",
+                q,
+            ),
+            daemon=True,
+        )
+        # The worker calls cached functions, which expect a script run context
+        add_script_run_ctx(worker, get_script_run_ctx())
+        worker.start()
+        st.session_state["_ocr_queue"] = q
+        ocr_pending = True
+
+if ocr_pending:
+    st.info("Running OCR...")
+elif ocr_job is not None:
+    if ocr_job[0] == "error":
+        _, reprs, tb = ocr_job
+        st.error("OCR failed to run with available call patterns.")
+        if reprs:
+            st.write("Exceptions (first, second, third):")
+            for exc in reprs:
+                st.write(exc)
+            st.write("Full traceback for debugging:")
+            st.text(tb)
+    else:
+        texts, raw_text = ocr_job[1]
+        if texts:
+            out = "\n".join(texts)
+            st.text_area("OCR Output", out, height=250)
+            st.session_state["messages"].append({"role":"assistant","content":f"OCR Result:\n{out}"})
+        else:
+            st.warning("No readable text detected. Raw OCR result shown below for debugging:")
+            st.code(raw_text, language=None)
+            st.session_state["messages"].append({"role":"assistant","content":"OCR Result: [no readable text]"})
  
-responses = {
-    "hello": "Hello! How can I assist you?",
-    "hi": "Hi there! What can I do for you?",
-    "how are you": "I'm just a program, but I'm doing great!",
-    "your name": "I'm Gemma 3 Chatbot, created using Streamlit!",
-    "time": f"The current time is {datetime.now().strftime('%H:%M:%S')}.",
-    "date": f"Today's date is {datetime.now().strftime('%Y-%m-%d')}.",
-    "bye": "Goodbye! Have a nice day.",
-    "thanks": "You're welcome!"
-}
+@st.cache_resource
+def load_intents():
+    # time/date are callables so they're evaluated when the message is sent
+    responses = {
+        "hello": "Hello! How can I assist you?",
+        "hi": "Hi there! What can I do for you?",
+        "how are you": "I'm just a program, but I'm doing great!",
+        "your name": "I'm Gemma 3 Chatbot, created using Streamlit!",
+        "time": lambda: f"The current time is {datetime.now().strftime('%H:%M:%S')}.",
+        "date": lambda: f"Today's date is {datetime.now().strftime('%Y-%m-%d')}.",
+        "bye": "Goodbye! Have a nice day.",
+        "thanks": "You're welcome!"
+    }
+    # One compiled alternation: a single scan over the text instead of one `in` check per key
+    intent_re = re.compile("|".join(f"(?P<k{i}>{re.escape(k)})" for i, k in enumerate(responses)))
+    return intent_re, list(responses.values())
+
+INTENT_RE, INTENT_REPLIES = load_intents()
 
 for msg in st.session_state["messages"]:
     if msg["role"] == "user":
         st.markdown(f"👤 *You:* {msg['content']}")
     else:
         st.markdown(f"🤖 *Bot:* {msg['content']}")
+        if "attachment_id" in msg:
+            st.code(st.session_state["_attachments"].get(msg["attachment_id"], ""), language=None)
 
 user_input = st.text_input("You: ", "")
 
+_BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+# Cap on the size of any intermediate result, so nested ** / * can't hang the app
+_MAX_RESULT_BITS = 4096
+
+def _bits(x):
+    return math.log2(abs(x)) if abs(x) > 1 else 0
+
+def _eval_node(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+        left, right = _eval_node(node.left), _eval_node(node.right)
+        if isinstance(node.op, ast.Pow):
+            size = right * _bits(left)
+        elif isinstance(node.op, ast.Mult):
+            size = _bits(left) + _bits(right)
+        else:
+            size = 0
+        if size > _MAX_RESULT_BITS:
+            raise ValueError("result too large")
+        return _BIN_OPS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+        return _UNARY_OPS[type(node.op)](_eval_node(node.operand))
+    raise ValueError(f"unsupported expression: {type(node).__name__}")
+
+@functools.lru_cache(maxsize=128)
+def safe_eval(expr):
+    """
+    Evaluate a plain arithmetic expression (numbers, + - * / % **, unary +/-).
+    Anything else raises ValueError instead of being executed.
+    """
+    return _eval_node(ast.parse(expr.strip(), mode="eval").body)
+
+@st.cache_resource
+def _ollama_session():
+    # Shared keep-alive connection to the local Ollama server
+    s = requests.Session()
+    s.headers.update({"Content-Type": "application/json"})
+    return s
+
 def ask_ollama(prompt):
+    # Stream tokens into a placeholder as they arrive; return the full reply
+    placeholder = st.empty()
+    reply = ""
+    # A previous run may have been interrupted mid-stream (e.g. Send clicked again);
+    # close it so Ollama stops generating for it
+    previous = st.session_state.pop("_active_ollama", None)
+    if previous is not None:
+        previous.close()
     try:
-        response = requests.post(
+        response = _ollama_session().post(
             "http://127.0.0.1:11434/api/generate",
-            json={"model": "gemma3:latest", "prompt": prompt, "stream": False},
+            json={"model": "gemma3:latest", "prompt": prompt, "stream": True},
+            stream=True,
             timeout=120
         )
-        if response.status_code == 200:
-            return response.json().get("response", "")
-        return f"Error: {response.status_code} {response.text}"
+        st.session_state["_active_ollama"] = response
+        if response.status_code != 200:
+            st.session_state.pop("_active_ollama", None)
+            return f"Error: {response.status_code} {response.text}"
+        # Read to the end (Ollama closes the body right after "done") so the
+        # keep-alive connection goes back to the session's pool
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            reply += chunk.get("response", "")
+            placeholder.markdown(f"🤖 *Bot:* {reply}")
+        st.session_state.pop("_active_ollama", None)
+        return reply
     except Exception as e:
+        # Only a broken stream needs closing; it can't be reused anyway
+        interrupted = st.session_state.pop("_active_ollama", None)
+        if interrupted is not None:
+            interrupted.close()
+        if reply:
+            return f"{reply}\n\nOllama error: {e}"
         return f"Ollama error: {e}"
 
 if st.button("Send"):
     if user_input.strip():
         st.session_state["messages"].append({"role":"user","content":user_input})
         text = user_input.lower().strip()
-        reply = None
-        for k,v in responses.items():
-            if k in text:
-                reply = v
-                break
+        m = INTENT_RE.search(text)
+        reply = INTENT_REPLIES[int(m.lastgroup[1:])] if m else None
+        if callable(reply):
+            reply = reply()
         if reply is None and any(ch.isdigit() for ch in text):
             try:
-                reply = str(eval(user_input))
+                reply = str(safe_eval(user_input))
             except:
                 reply = "Couldn't evaluate expression."
         if reply is None:
             reply = ask_ollama(user_input)
         st.session_state["messages"].append({"role":"assistant","content":reply})
-        st.rerun()
\ No newline at end of file
+        st.rerun()
+
+# Keep polling the background OCR job; the rest of the page stays usable meanwhile
+if "_ocr_queue" in st.session_state:
+    time.sleep(0.5)
+    st.rerun()
\ No newline at end of file